@@ -11,6 +11,14 @@ ConnectionId: TypeAlias = Hashable
 Message: TypeAlias = Sequence[bytes]
 
 
+class InvalidMessage(Exception):
+    """Raised by handlers for a message the broker cannot act on.
+
+    The broker closes the connection that sent the message
+    instead of letting the error stop it.
+    """
+
+
 class Connection(Protocol):
 
     def read(self, num_bytes) -> bytes:
@@ -28,6 +36,12 @@ class ConnectionsActivity:
 
 
 class ConnectionHandler(Protocol):
+    """Broker's messaging logic.
+
+    A handler may also define `pop_deferred_replies()`, returning
+    `(connection_id, message)` replies to messages received in earlier
+    calls to `on_message`. The broker writes them on every iteration.
+    """
 
     def on_new_connection(self, connection: ConnectionId):
         pass
@@ -35,7 +49,9 @@ class ConnectionHandler(Protocol):
     def on_connection_closed(self, connection: ConnectionId):
         pass
 
-    def on_message(self, msg: Message) -> Message | None:
+    def on_message(
+            self, *, connection_id: ConnectionId, msg_fields: Message,
+    ) -> Message | None:
         pass
 
 
@@ -50,13 +66,43 @@ class ConnectionManager(Protocol):
     def get_activity(self) -> ConnectionsActivity:
         pass
 
+    def close_connection(self, connection_id: ConnectionId):
+        """Close a connection.
+
+        It is reported in `closed_ids` of the next activity,
+        which the broker ignores as it has already dropped it.
+        """
+
+
+class Replicator(Protocol):
+
+    def flush(self):
+        pass
+
 
 class Broker:
 
-    def __init__(self, *, handler, connection_manager):
+    def __init__(
+            self,
+            *,
+            handler,
+            connection_manager,
+            replicator: Replicator | None = None,
+    ):
         self._connection_manager = connection_manager
         self._connections = {}
         self._handler = handler
+        self._replicator = replicator
+        self._pop_deferred_replies = getattr(
+                handler, 'pop_deferred_replies', None)
+
+    @property
+    def handler(self):
+        return self._handler
+
+    @property
+    def replicator(self):
+        return self._replicator
 
     def __enter__(self):
         self._connection_manager.__enter__()
@@ -67,16 +113,76 @@ class Broker:
 
     def process_connections(self):
         connections = self._connection_manager.get_activity()
+        # Closed connections go first, as their ids may be reused
+        # by new connections reported with the same activity.
+        for closed_id in connections.closed_ids:
+            # Connections closed by the broker are already dropped.
+            if self._connections.pop(closed_id, None) is not None:
+                self._handler.on_connection_closed(closed_id)
         for new in connections.new:
             self._connections[new.id] = new
             self._handler.on_new_connection(new.id)
-        for readable_id in connections.readable_ids:
-            self._process_message(self._connections[readable_id])
-        for closed_id in connections.closed_ids:
-            del self._connections[closed_id]
-            self._handler.on_connection_closed(closed_id)
+        if (replicator := self._replicator) is None:
+            for connection in self._get_readable(connections.readable_ids):
+                self._process_message(connection)
+            for connection, to_reply in self._get_deferred_replies():
+                self._write(connection, to_reply)
+        else:
+            # Replies are released only once the mutations
+            # behind them have been handed over to the replicator.
+            replies = []
+            for connection in self._get_readable(connections.readable_ids):
+                if (to_reply := self._get_reply(connection)) is not None:
+                    replies.append((connection, to_reply))
+            replies.extend(self._get_deferred_replies())
+            replicator.flush()
+            for connection, to_reply in replies:
+                self._write(connection, to_reply)
+
+    def _get_readable(self, readable_ids):
+        # A connection may be closed by the broker while
+        # the rest of the activity is being processed.
+        connections = self._connections
+        for readable_id in readable_ids:
+            if (connection := connections.get(readable_id)) is not None:
+                yield connection
+
+    def _get_deferred_replies(self):
+        if (pop_deferred_replies := self._pop_deferred_replies) is None:
+            return []
+        connections = self._connections
+        return [
+            (connections[connection_id], to_reply)
+            for connection_id, to_reply in pop_deferred_replies()
+            if connection_id in connections
+        ]
 
     def _process_message(self, connection):
+        if (to_reply := self._get_reply(connection)) is not None:
+            self._write(connection, to_reply)
+
+    def _write(self, connection, to_reply):
+        if self._connections.get(connection.id) is not connection:
+            return
+        try:
+            msg = serialize(to_reply)
+        except (TypeError, ValueError, LookupError):
+            # E.g. a payload published by an embedded connection
+            # that is not `bytes`. The reply is lost.
+            self._close_connection(connection.id)
+            return
+        connection.write(msg)
+
+    def _get_reply(self, connection):
         msg_fields = deserialize(connection)
-        if (to_reply := self._handler.on_message(msg_fields=msg_fields)):
-            connection.write(serialize(to_reply))
+        try:
+            return self._handler.on_message(
+                    connection_id=connection.id, msg_fields=msg_fields)
+        except InvalidMessage:
+            self._close_connection(connection.id)
+            return None
+
+    def _close_connection(self, connection_id):
+        del self._connections[connection_id]
+        self._connection_manager.close_connection(connection_id)
+        self._handler.on_connection_closed(connection_id)
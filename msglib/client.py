@@ -1,8 +1,18 @@
+from msglib.embedded import EmbeddedConnection
 from msglib.message import deserialize, serialize
-from msglib.handlers import ChannelType, Command, QMsg
+from msglib.handlers import (
+        ChannelType,
+        Command,
+        GroupPullMsg,
+        PartitionedPublishMsg,
+        QMsg,
+)
 
 
 def publish_to_q(*, connection, q_id, payload):
+    if isinstance(connection, EmbeddedConnection):
+        connection.publish_to_q(q_id=q_id, payload=payload)
+        return
     msg = QMsg(
             channel_type=ChannelType.QUEUE,
             q_id=q_id,
@@ -12,7 +22,22 @@ def publish_to_q(*, connection, q_id, payload):
     _publish(connection=connection, msg=msg)
 
 
+def publish_to_partitioned_q(*, connection, q_id, partition_key, payload):
+    if isinstance(connection, EmbeddedConnection):
+        connection.publish_to_partitioned_q(
+                q_id=q_id, partition_key=partition_key, payload=payload)
+        return
+    msg = PartitionedPublishMsg(
+            q_id=q_id,
+            partition_key=partition_key,
+            payload=payload,
+    )
+    _publish(connection=connection, msg=msg)
+
+
 def blocking_pull_subscribe_to_queue(*, connection, q_id):
+    if isinstance(connection, EmbeddedConnection):
+        return _EmbeddedQSub(connection=connection, q_id=q_id)
     return _QSub(connection=connection, q_id=q_id)
 
 
@@ -34,12 +59,65 @@ class _QSub:
                 command=Command.PULL_MSG,
         )
         self._connection = connection
+        self._pull_pending = False
 
     def __next__(self):
-        _publish(connection=self._connection, msg=self._pull_msg)
+        # The broker answers once there is a message, so a pull
+        # that could not be answered yet must not be sent again.
+        if not self._pull_pending:
+            _publish(connection=self._connection, msg=self._pull_msg)
+            self._pull_pending = True
         msg_fields = deserialize(self._connection)
+        self._pull_pending = False
         return AckableQMsg(*msg_fields)
 
 
+class _EmbeddedQSub:
+
+    def __init__(self, *, connection, q_id):
+        self._connection = connection
+        self._q_id = q_id
+
+    def __next__(self):
+        return AckableQMsg(self._connection.pull_from_q(q_id=self._q_id))
+
+
+def group_pull_subscribe_to_queue(*, connection, q_id, group_id):
+    if isinstance(connection, EmbeddedConnection):
+        return _EmbeddedGroupSub(
+                connection=connection, q_id=q_id, group_id=group_id)
+    return _GroupSub(connection=connection, q_id=q_id, group_id=group_id)
+
+
+class _GroupSub:
+
+    def __init__(self, *, connection, q_id, group_id):
+        self._pull_msg = GroupPullMsg(q_id=q_id, group_id=group_id)
+        self._connection = connection
+        self._pull_pending = False
+
+    def __next__(self):
+        # The broker answers once there is a message, so a pull
+        # that could not be answered yet must not be sent again.
+        if not self._pull_pending:
+            _publish(connection=self._connection, msg=self._pull_msg)
+            self._pull_pending = True
+        msg_fields = deserialize(self._connection)
+        self._pull_pending = False
+        return AckableQMsg(*msg_fields)
+
+
+class _EmbeddedGroupSub:
+
+    def __init__(self, *, connection, q_id, group_id):
+        self._connection = connection
+        self._q_id = q_id
+        self._group_id = group_id
+
+    def __next__(self):
+        return AckableQMsg(self._connection.pull_from_group(
+                q_id=self._q_id, group_id=self._group_id))
+
+
 def _publish(*, connection, msg):
     connection.write(serialize(msg.to_bytes_tuple()))
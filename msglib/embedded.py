@@ -0,0 +1,69 @@
+from contextlib import contextmanager
+
+from msglib.broker import Broker
+from msglib.handlers import ChannelType
+
+
+class ReplicationNotSupported(Exception):
+    pass
+
+
+class EmbeddedConnection:
+    """Connection to a broker running in the same process.
+
+    Payloads are put into and taken from the broker's queues directly,
+    without serialization, so they can be any Python objects.
+    A payload that is not `bytes` cannot be sent to a remote consumer:
+    the broker closes the consumer's connection and the payload is lost.
+    Pulling blocks the calling thread, not the broker, until a message
+    is available, creating the queue if needed, like a remote pull.
+    Remote pulls waiting on a queue are answered first.
+
+    Embedded traffic bypasses the mutation listeners, so brokers with
+    a replicator do not accept embedded connections.
+
+    Used through `msglib.client`, like any other connection.
+    """
+
+    def __init__(self, broker: Broker):
+        if broker.replicator is not None:
+            raise ReplicationNotSupported(
+                    'Embedded connections to a replicated broker'
+                    + ' would bypass replication.'
+            )
+        handler = broker.handler
+        self._queue_handler = handler.get_channel(ChannelType.QUEUE)
+        self._partitioned_queue_handler = handler.get_channel(
+                ChannelType.PARTITIONED_QUEUE)
+        self._qs = {}
+
+    def publish_to_q(self, *, q_id, payload):
+        self._get_q(q_id).put(payload)
+
+    def pull_from_q(self, *, q_id):
+        return self._get_q(q_id).get()
+
+    def _get_q(self, q_id):
+        if (q := self._qs.get(q_id)) is None:
+            q = self._qs[q_id] = self._queue_handler.get_queue(
+                    q_id, create=True)
+        return q
+
+    def publish_to_partitioned_q(self, *, q_id, partition_key, payload):
+        self._partitioned_queue_handler.publish(q_id, partition_key, payload)
+
+    def pull_from_group(self, *, q_id, group_id):
+        return self._partitioned_queue_handler.pull(self, q_id, group_id)
+
+    def close(self):
+        # Leaves consumer groups, so partitions are rebalanced.
+        self._partitioned_queue_handler.on_connection_closed(self)
+
+
+@contextmanager
+def connect(broker: Broker):
+    connection = EmbeddedConnection(broker)
+    try:
+        yield connection
+    finally:
+        connection.close()
@@ -1,64 +1,711 @@
-from collections import defaultdict
+from collections import Counter, deque
+from collections.abc import Callable, Hashable
 from enum import Enum, auto
-from queue import Queue
+from functools import partial
+import threading
+from time import perf_counter_ns
 from typing import NamedTuple
+import zlib
 
-from msglib.message import int_from_bytes, int_to_bytes
+from msglib.broker import InvalidMessage
+from msglib.message import int_to_bytes
 
 
-class _Queue:
+class UnknownChannelType(InvalidMessage):
+    pass
+
+
+class UnknownCommand(InvalidMessage):
+    pass
+
+
+class UnknownQueue(InvalidMessage):
+    pass
+
+
+class MalformedMessage(InvalidMessage):
+    pass
+
+
+def _require_fields(msg_fields, min_fields):
+    if len(msg_fields) < min_fields:
+        raise MalformedMessage(
+                f'{len(msg_fields)} fields, at least {min_fields} expected.')
+
+
+def _unpack(msg_fields, num_fields):
+    if len(msg_fields) != num_fields:
+        raise MalformedMessage(
+                f'{len(msg_fields)} fields, {num_fields} expected.')
+    return msg_fields
+
+
+class DispatchStage(Enum):
+    CHANNEL_LOOKUP = auto()
+    COMMAND_LOOKUP = auto()
+    QUEUE_RESOLUTION = auto()
+    EXECUTION = auto()
+
+
+class DispatchMetrics:
+    """Accumulates time spent in each `DispatchStage`.
+
+    Passing an instance to a handler switches it to a measured dispatch
+    path. Without it no timing is done at all.
+    """
 
     def __init__(self):
-        self._q: Queue[bytes] = Queue()
+        self.counts: Counter[DispatchStage] = Counter()
+        self.total_ns: Counter[DispatchStage] = Counter()
+
+    def record(self, stage, elapsed_ns):
+        self.counts[stage] += 1
+        self.total_ns[stage] += elapsed_ns
+
+    def mean_ns(self, stage):
+        count = self.counts[stage]
+        return self.total_ns[stage] / count if count else 0.0
+
+
+_NOTHING = object()
+
+
+class _Queue:
+    """FIFO queue shared by the broker loop and embedded connections.
+
+    A remote pull that finds the queue empty waits and is answered
+    by the next `put`, through `deliver(connection_id, payload)`,
+    before any embedded `get` blocked on the queue.
+    """
+
+    def __init__(self, *, deliver):
+        self._payloads: deque = deque()
+        # Waiting pulls, as `(connection_id, msg_fields)`.
+        self._waiting: deque[tuple[Hashable, list[bytes]]] = deque()
+        self._not_empty = threading.Condition(threading.Lock())
+        self._deliver = deliver
 
     def put(self, payload):
-        self._q.put(payload)
+        """Returns the fields of the pull given `payload`, if any."""
+        with self._not_empty:
+            if not self._waiting:
+                self._payloads.append(payload)
+                self._not_empty.notify()
+                return None
+            connection_id, pull_fields = self._waiting.popleft()
+        self._deliver(connection_id, payload)
+        return pull_fields
 
     def get(self):
-        return self._q.get()
+        with self._not_empty:
+            self._not_empty.wait_for(lambda: self._payloads)
+            return self._payloads.popleft()
+
+    def take(self):
+        with self._not_empty:
+            return self._payloads.popleft() if self._payloads else _NOTHING
+
+    def take_or_wait(self, connection_id, pull_fields):
+        with self._not_empty:
+            if self._payloads:
+                return self._payloads.popleft()
+            self._waiting.append((connection_id, pull_fields))
+            return _NOTHING
+
+    def cancel(self, connection_id):
+        with self._not_empty:
+            self._waiting = deque(
+                    waiting for waiting in self._waiting
+                    if waiting[0] != connection_id
+            )
+
+    def snapshot(self):
+        with self._not_empty:
+            return list(self._payloads)
+
+    def clear(self):
+        with self._not_empty:
+            self._payloads.clear()
+
+
+class _QCommand(NamedTuple):
+    fn: Callable
+    creates_queue: bool
+    mutates: bool
+    replay_fn: Callable | None
 
 
 class QueueHandler:
+    """Channel handler for `ChannelType.QUEUE` messages.
 
-    def __init__(self):
-        self._qs = defaultdict(_Queue)
+    Commands and queues are looked up by the raw bytes of their
+    fields, so they must be encoded with `int_to_bytes`, as `QMsg`
+    does. E.g. `b'\\x00\\x01'` and `b'\\x01'` are different queues.
+    A message without the channel type, command and queue id fields,
+    or with a wrong number of fields for a built-in command,
+    raises `MalformedMessage`.
+    Queues are created by the first publish or pull addressed to them.
+    Any other command addressed to a queue that does not exist raises
+    `UnknownQueue`. A pull from an empty queue is answered by the next
+    publish, see `pop_deferred_replies`.
+    Mutation listeners are called with the fields of every executed
+    command that changes the state of a queue. Another handler can
+    apply those fields with `replay`.
+    """
+
+    def __init__(self, *, metrics: DispatchMetrics | None = None):
+        self._qs: dict[bytes, _Queue] = {}
+        self._commands: dict[bytes, _QCommand] = {}
+        self._mutation_listeners: list[Callable] = []
+        self._deferred_replies: deque[tuple[Hashable, tuple]] = deque()
+        self._metrics = metrics
+        self._dispatch = (
+                self._dispatch_measured if metrics is not None
+                else self._dispatch_unmeasured
+        )
 
-    def __call__(self, msg_tail):
-        command, q_id, *tail = msg_tail
-        q_id = int_from_bytes(q_id)
-        match int_from_bytes(command):
-            case Command.PUBLISH:
-                payload, = tail
-                return self._handle_publish(q_id, payload=payload)
-            case Command.PULL_MSG:
-                return self._handle_pull_msg(q_id)
+        # The built-in commands report their own mutations,
+        # as a waiting pull is only executed by a later publish.
+        self.register_command(
+                Command.PUBLISH,
+                self._handle_publish,
+                creates_queue=True,
+        )
+        self.register_command(
+                Command.PULL_MSG,
+                self._handle_pull_msg,
+                creates_queue=True,
+                replay_fn=self._replay_pull_msg,
+        )
 
-    def _handle_publish(self, q_id, *, payload):
-        self._qs[q_id].put(payload)
+    def register_command(
+            self,
+            command: int,
+            fn,
+            *,
+            creates_queue=False,
+            mutates=False,
+            replay_fn=None,
+    ):
+        """Route `command` to `fn(connection_id, queue, msg_fields)`.
 
-    def _handle_pull_msg(self, q_id):
-        return (self._qs[q_id].get(),)
+        `msg_fields` is the whole message, header included.
+        `replay_fn(queue, msg_fields)`, if given, is used by `replay`
+        instead of `fn`, which is then called with `None` as
+        the connection id. It must not block and returns whether the queue
+        held what the mutation expected.
+        Registering an already known command replaces its handler.
+        """
+        self._commands[int_to_bytes(command)] = _QCommand(
+                fn=fn,
+                creates_queue=creates_queue,
+                mutates=mutates,
+                replay_fn=replay_fn,
+        )
 
+    def add_mutation_listener(self, listener):
+        self._mutation_listeners.append(listener)
 
-class ConnectionHandler:
+    def _report(self, msg_fields):
+        for listener in self._mutation_listeners:
+            listener(msg_fields)
 
-    def __init__(self):
-        self._handlers = {
-            ChannelType.QUEUE: QueueHandler(),
+    def on_connection_closed(self, connection_id):
+        for q in list(self._qs.values()):
+            q.cancel(connection_id)
+
+    def pop_deferred_replies(self):
+        """Replies to pulls that had to wait, as `(connection_id, msg)`."""
+        replies = []
+        # Embedded connections may append from other threads.
+        deferred_replies = self._deferred_replies
+        while deferred_replies:
+            replies.append(deferred_replies.popleft())
+        return replies
+
+    def _defer_reply(self, connection_id, payload):
+        self._deferred_replies.append((connection_id, (payload,)))
+
+    def __call__(self, connection_id, msg_fields):
+        return self._dispatch(connection_id, msg_fields)
+
+    def _dispatch_unmeasured(self, connection_id, msg_fields):
+        _require_fields(msg_fields, 3)
+        command = self._get_command(msg_fields[1])
+        q = self._resolve_q(msg_fields[2], create=command.creates_queue)
+        ret = command.fn(connection_id, q, msg_fields)
+        if command.mutates:
+            self._report(msg_fields)
+        return ret
+
+    def _dispatch_measured(self, connection_id, msg_fields):
+        record = self._metrics.record  # type: ignore
+
+        start = perf_counter_ns()
+        _require_fields(msg_fields, 3)
+        command = self._get_command(msg_fields[1])
+        looked_up = perf_counter_ns()
+        q = self._resolve_q(msg_fields[2], create=command.creates_queue)
+        resolved = perf_counter_ns()
+        ret = command.fn(connection_id, q, msg_fields)
+        if command.mutates:
+            self._report(msg_fields)
+        done = perf_counter_ns()
+
+        record(DispatchStage.COMMAND_LOOKUP, looked_up - start)
+        record(DispatchStage.QUEUE_RESOLUTION, resolved - looked_up)
+        record(DispatchStage.EXECUTION, done - resolved)
+        return ret
+
+    def _get_command(self, raw_command):
+        try:
+            return self._commands[raw_command]
+        except KeyError:
+            raise UnknownCommand(raw_command) from None
+
+    def _resolve_q(self, raw_q_id, *, create):
+        if (q := self._qs.get(raw_q_id)) is None:
+            if not create:
+                raise UnknownQueue(raw_q_id)
+            q = self._create_q(raw_q_id)
+        return q
+
+    def replay(self, msg_fields):
+        """Apply a mutation reported to another handler's listeners.
+
+        Returns `False` if the mutation did not match the local state,
+        e.g. a dequeue from an empty queue, in which case it is dropped.
+        """
+        _require_fields(msg_fields, 3)
+        command = self._get_command(msg_fields[1])
+        q = self._resolve_q(msg_fields[2], create=True)
+        if command.replay_fn is None:
+            command.fn(None, q, msg_fields)
+            applied = True
+        else:
+            applied = command.replay_fn(q, msg_fields)
+        if command.mutates:
+            self._report(msg_fields)
+        return applied
+
+    def snapshot(self):
+        """Publish mutations that recreate the content of all queues."""
+        raw_header = (
+                int_to_bytes(ChannelType.QUEUE), int_to_bytes(Command.PUBLISH))
+        return [
+            (*raw_header, raw_q_id, payload)
+            for raw_q_id, q in list(self._qs.items())
+            for payload in q.snapshot()
+        ]
+
+    def clear(self):
+        for q in list(self._qs.values()):
+            q.clear()
+
+    def _create_q(self, raw_q_id):
+        # `setdefault` is atomic, so a queue created concurrently
+        # by an embedded connection is never replaced.
+        return self._qs.setdefault(
+                raw_q_id, _Queue(deliver=self._defer_reply))
+
+    def get_queue(self, q_id: int, *, create=False):
+        """Give direct access to a queue, see `msglib.embedded`.
+
+        Operations on the returned queue bypass dispatch, so they are
+        neither measured nor reported to mutation listeners.
+        """
+        return self._resolve_q(int_to_bytes(q_id), create=create)
+
+    def _handle_publish(self, _connection_id, q, msg_fields):
+        _, _, _, payload = _unpack(msg_fields, 4)
+        pull_fields = q.put(payload)
+        self._report(msg_fields)
+        if pull_fields is not None:
+            self._report(pull_fields)
+
+    def _handle_pull_msg(self, connection_id, q, msg_fields):
+        _unpack(msg_fields, 3)
+        if (payload := q.take_or_wait(connection_id, msg_fields)) is _NOTHING:
+            return None
+        self._report(msg_fields)
+        return (payload,)
+
+    def _replay_pull_msg(self, q, msg_fields):
+        if q.take() is _NOTHING:
+            return False
+        self._report(msg_fields)
+        return True
+
+
+class _Partition:
+    """Messages from `first_offset` on, with O(1) access by offset.
+
+    Dropped messages are skipped by moving `_head` and are removed
+    from the list once they make up half of it.
+    """
+
+    def __init__(self, *, max_length):
+        self._log: list[bytes] = []
+        self._head = 0
+        self._max_length = max_length
+        self.first_offset = 0
+
+    @property
+    def end_offset(self):
+        return self.first_offset + len(self._log) - self._head
+
+    def append(self, payload):
+        self._log.append(payload)
+        if len(self._log) - self._head > self._max_length:
+            self._drop(1)
+
+    def get(self, offset):
+        return self._log[self._head + offset - self.first_offset]
+
+    def trim(self, offset):
+        if offset > self.first_offset:
+            self._drop(offset - self.first_offset)
+
+    def _drop(self, num_messages):
+        self._head += num_messages
+        self.first_offset += num_messages
+        if self._head * 2 >= len(self._log):
+            del self._log[:self._head]
+            self._head = 0
+
+
+class _ConsumerGroup:
+
+    def __init__(self, *, partitions):
+        self._num_partitions = len(partitions)
+        self.offsets = [partition.first_offset for partition in partitions]
+        self.members: list[Hashable] = []
+        self.assignment: dict[Hashable, list[int]] = {}
+        self.owners: list[Hashable | None] = [None] * len(partitions)
+        # Members waiting for a message, with their delivery callbacks.
+        self.parked: dict[Hashable, Callable] = {}
+        self._cursors: dict[Hashable, int] = {}
+
+    def join(self, member):
+        self.members.append(member)
+        self._rebalance()
+
+    def leave(self, member):
+        if member in self.assignment:
+            self.members.remove(member)
+            self.parked.pop(member, None)
+            self._rebalance()
+
+    def _rebalance(self):
+        members = self.members
+        self.assignment = {member: [] for member in members}
+        self.owners = [None] * self._num_partitions
+        if members:
+            for partition in range(self._num_partitions):
+                owner = members[partition % len(members)]
+                self.assignment[owner].append(partition)
+                self.owners[partition] = owner
+        self._cursors = dict.fromkeys(members, 0)
+
+    def next_partition_with_data(self, member, partitions):
+        assigned = self.assignment[member]
+        cursor = self._cursors[member]
+        for i in range(len(assigned)):
+            partition = assigned[(cursor + i) % len(assigned)]
+            end_offset = partitions[partition].end_offset
+            if (
+                    self.offsets[partition] < end_offset
+                    and partitions[partition].first_offset < end_offset
+            ):
+                self._cursors[member] = cursor + i + 1
+                return partition
+        return None
+
+
+class _PartitionedQueue:
+
+    def __init__(self, *, num_partitions, max_partition_length):
+        self.partitions = [
+            _Partition(max_length=max_partition_length)
+            for _ in range(num_partitions)
+        ]
+        self.groups: dict[bytes, _ConsumerGroup] = {}
+
+    def publish(self, partition_key, payload):
+        partitions = self.partitions
+        partition = zlib.crc32(partition_key) % len(partitions)
+        partitions[partition].append(payload)
+        for group in self.groups.values():
+            if (
+                    (owner := group.owners[partition]) is not None
+                    and (deliver := group.parked.pop(owner, None))
+            ):
+                deliver(self._take(group, owner))
+
+    def pull(self, member, group_id, deliver):
+        """Take the next message for `member` of group `group_id`.
+
+        If there is none, `_NOTHING` is returned and `deliver`
+        is called with the message once there is one.
+        """
+        if (group := self.groups.get(group_id)) is None:
+            group = self.groups[group_id] = _ConsumerGroup(
+                    partitions=self.partitions)
+        if member not in group.assignment:
+            group.join(member)
+
+        if (payload := self._take(group, member)) is _NOTHING:
+            group.parked[member] = deliver
+        return payload
+
+    def _take(self, group, member):
+        partitions = self.partitions
+        partition = group.next_partition_with_data(member, partitions)
+        if partition is None:
+            return _NOTHING
+        # Messages beyond the retention bound may have been dropped.
+        offset = max(
+                group.offsets[partition], partitions[partition].first_offset)
+        payload = partitions[partition].get(offset)
+        group.offsets[partition] = offset + 1
+        partitions[partition].trim(min(
+                other.offsets[partition] for other in self.groups.values()))
+        return payload
+
+    def leave(self, member):
+        for group in self.groups.values():
+            if member in group.assignment:
+                group.leave(member)
+                # Remaining members may have been given
+                # partitions with messages they wait for.
+                for parked in list(group.parked):
+                    if (payload := self._take(group, parked)) is not _NOTHING:
+                        group.parked.pop(parked)(payload)
+
+
+class PartitionedQueueHandler:
+    """Channel handler for `ChannelType.PARTITIONED_QUEUE` messages.
+
+    A publish is appended to the partition its key hashes to.
+    Pulls are made on behalf of a consumer group: the connection
+    pulling joins the group and is served only from the partitions
+    assigned to it, so messages with the same key are delivered
+    in order. Partitions are reassigned whenever a member joins
+    or its connection closes. A pull that finds no message is
+    answered later, see `pop_deferred_replies`, and a pull
+    may create the queue.
+
+    Embedded connections use `publish` and `pull` from other threads,
+    so all state is guarded by a condition variable.
+
+    A group starts from the oldest message still held and a message
+    is dropped once every group has consumed it. A partition holds
+    at most `max_partition_length` messages, dropping the oldest,
+    so groups without members do not pin messages forever.
+
+    Partitioned queues are not replicated.
+    """
+
+    def __init__(
+            self,
+            *,
+            num_partitions: int,
+            max_partition_length: int = 100_000,
+    ):
+        self._num_partitions = num_partitions
+        self._max_partition_length = max_partition_length
+        self._qs: dict[bytes, _PartitionedQueue] = {}
+        self._deferred_replies: list[tuple[Hashable, tuple[bytes]]] = []
+        self._condition = threading.Condition()
+        self._commands: dict[bytes, Callable] = {
+            int_to_bytes(Command.PUBLISH): self._handle_publish,
+            int_to_bytes(Command.PULL_MSG): self._handle_pull_msg,
         }
 
-    def on_new_connection(self, connection_id):
-        print(connection_id)
+    def get_assignment(self, q_id: int, group_id: int):
+        with self._condition:
+            q = self._qs[int_to_bytes(q_id)]
+            group = q.groups[int_to_bytes(group_id)]
+            return {
+                member: tuple(partitions)
+                for member, partitions in group.assignment.items()
+            }
+
+    def on_connection_closed(self, connection_id):
+        with self._condition:
+            for q in self._qs.values():
+                q.leave(connection_id)
+
+    def pop_deferred_replies(self):
+        """Replies to pulls that had to wait, as `(connection_id, msg)`."""
+        with self._condition:
+            replies = self._deferred_replies
+            self._deferred_replies = []
+        return replies
+
+    def publish(self, q_id: int, partition_key: bytes, payload):
+        with self._condition:
+            self._get_or_create_q(int_to_bytes(q_id)).publish(
+                    partition_key, payload)
+
+    def pull(self, member: Hashable, q_id: int, group_id: int):
+        """Block the calling thread until `member` gets a message."""
+        delivered: list = []
+        with self._condition:
+            payload = self._get_or_create_q(int_to_bytes(q_id)).pull(
+                    member,
+                    int_to_bytes(group_id),
+                    partial(self._deliver_locally, delivered),
+            )
+            if payload is not _NOTHING:
+                return payload
+            self._condition.wait_for(lambda: delivered)
+        return delivered[0]
+
+    def _deliver_locally(self, delivered, payload):
+        delivered.append(payload)
+        self._condition.notify_all()
 
-    def on_message(self, *, msg_fields):
-        channel_type, *tail = msg_fields
-        return self._handlers[int_from_bytes(channel_type)](
-                tail,
+    def __call__(self, connection_id, msg_fields):
+        _require_fields(msg_fields, 2)
+        try:
+            handle = self._commands[msg_fields[1]]
+        except KeyError:
+            raise UnknownCommand(msg_fields[1]) from None
+        with self._condition:
+            return handle(connection_id, msg_fields)
+
+    def _get_or_create_q(self, raw_q_id):
+        if (q := self._qs.get(raw_q_id)) is None:
+            q = self._qs[raw_q_id] = _PartitionedQueue(
+                    num_partitions=self._num_partitions,
+                    max_partition_length=self._max_partition_length,
+            )
+        return q
+
+    def _handle_publish(self, _, msg_fields):
+        _, _, raw_q_id, partition_key, payload = _unpack(msg_fields, 5)
+        self._get_or_create_q(raw_q_id).publish(partition_key, payload)
+
+    def _handle_pull_msg(self, connection_id, msg_fields):
+        _, _, raw_q_id, raw_group_id = _unpack(msg_fields, 4)
+        payload = self._get_or_create_q(raw_q_id).pull(
+                connection_id,
+                raw_group_id,
+                partial(self._defer_reply, connection_id),
         )
+        return None if payload is _NOTHING else (payload,)
+
+    def _defer_reply(self, connection_id, payload):
+        self._deferred_replies.append((connection_id, (payload,)))
+
+
+class ConnectionHandler:
+    """Routes messages to channel handlers by the raw channel type field.
+
+    A channel handler is called as `handler(connection_id, msg_fields)`
+    and may return a message to reply with. If it defines
+    `on_new_connection` or `on_connection_closed` they are called too.
+    If it defines `pop_deferred_replies`, the replies it returns are
+    collected by `pop_deferred_replies` of this handler.
+    """
+
+    def __init__(
+            self,
+            *,
+            metrics: DispatchMetrics | None = None,
+            num_partitions: int = 16,
+            max_partition_length: int = 100_000,
+    ):
+        self._channels: dict[bytes, Callable] = {}
+        self._on_new: list[Callable] = []
+        self._on_closed: list[Callable] = []
+        self._deferred_reply_sources: list[Callable] = []
+        self._metrics = metrics
+        self._dispatch = (
+                self._dispatch_measured if metrics is not None
+                else self._dispatch_unmeasured
+        )
+
+        self.register_channel(
+                ChannelType.QUEUE, QueueHandler(metrics=metrics))
+        self.register_channel(
+                ChannelType.PARTITIONED_QUEUE,
+                PartitionedQueueHandler(
+                    num_partitions=num_partitions,
+                    max_partition_length=max_partition_length,
+                ),
+        )
+
+    def register_channel(self, channel_type: int, handler):
+        """Route `channel_type` messages to `handler`.
+
+        Registering an already known channel type replaces its handler.
+        """
+        key = int_to_bytes(channel_type)
+        if (previous := self._channels.get(key)) is not None:
+            self._unhook(previous)
+        self._channels[key] = handler
+        if (on_new := getattr(handler, 'on_new_connection', None)):
+            self._on_new.append(on_new)
+        if (on_closed := getattr(handler, 'on_connection_closed', None)):
+            self._on_closed.append(on_closed)
+        if (pop := getattr(handler, 'pop_deferred_replies', None)):
+            self._deferred_reply_sources.append(pop)
+
+    def get_channel(self, channel_type: int):
+        return self._get_channel(int_to_bytes(channel_type))
+
+    def _unhook(self, handler):
+        for hooks, name in [
+                (self._on_new, 'on_new_connection'),
+                (self._on_closed, 'on_connection_closed'),
+                (self._deferred_reply_sources, 'pop_deferred_replies'),
+        ]:
+            if (hook := getattr(handler, name, None)) in hooks:
+                hooks.remove(hook)
+
+    def on_new_connection(self, connection_id):
+        for on_new in self._on_new:
+            on_new(connection_id)
+
+    def on_connection_closed(self, connection_id):
+        for on_closed in self._on_closed:
+            on_closed(connection_id)
+
+    def pop_deferred_replies(self):
+        return [
+            reply
+            for pop in self._deferred_reply_sources
+            for reply in pop()
+        ]
+
+    def on_message(self, *, connection_id, msg_fields):
+        return self._dispatch(connection_id, msg_fields)
+
+    def _dispatch_unmeasured(self, connection_id, msg_fields):
+        _require_fields(msg_fields, 1)
+        return self._get_channel(msg_fields[0])(connection_id, msg_fields)
+
+    def _dispatch_measured(self, connection_id, msg_fields):
+        start = perf_counter_ns()
+        _require_fields(msg_fields, 1)
+        handler = self._get_channel(msg_fields[0])
+        self._metrics.record(  # type: ignore
+                DispatchStage.CHANNEL_LOOKUP, perf_counter_ns() - start)
+        return handler(connection_id, msg_fields)
+
+    def _get_channel(self, raw_channel_type):
+        try:
+            return self._channels[raw_channel_type]
+        except KeyError:
+            raise UnknownChannelType(raw_channel_type) from None
 
 
 class ChannelType(int, Enum):
     QUEUE = auto()
+    REPLICATION = auto()
+    PARTITIONED_QUEUE = auto()
 
 
 class Command(int, Enum):
@@ -78,4 +725,34 @@ class QMsg(NamedTuple):
             int_to_bytes(self.channel_type),
             int_to_bytes(self.command),
             int_to_bytes(self.q_id),
-        ) + ((self.payload,) if self.payload else ())
+        ) + ((self.payload,) if self.payload is not None else ())
+
+
+class PartitionedPublishMsg(NamedTuple):
+
+    q_id: int
+    partition_key: bytes
+    payload: bytes
+
+    def to_bytes_tuple(self):
+        return (
+            int_to_bytes(ChannelType.PARTITIONED_QUEUE),
+            int_to_bytes(Command.PUBLISH),
+            int_to_bytes(self.q_id),
+            self.partition_key,
+            self.payload,
+        )
+
+
+class GroupPullMsg(NamedTuple):
+
+    q_id: int
+    group_id: int
+
+    def to_bytes_tuple(self):
+        return (
+            int_to_bytes(ChannelType.PARTITIONED_QUEUE),
+            int_to_bytes(Command.PULL_MSG),
+            int_to_bytes(self.q_id),
+            int_to_bytes(self.group_id),
+        )
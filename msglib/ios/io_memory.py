@@ -30,6 +30,7 @@ class InMemoryConnectionManager:
         self._with_data_ids: set[ConnectionId] = set()
         self._new_connections: list[_ConnectionParty] = []
         self._closed_connection_ids: list[ConnectionId] = []
+        self._closed: set[ConnectionId] = set()
         transport.register_on_connection_request(
                 endpoint_id=endpoint_id,
                 callback=self._on_connection_request,
@@ -43,10 +44,10 @@ class InMemoryConnectionManager:
 
     def _on_read(self, *, connection_id, has_more_data):
         if not has_more_data:
-            self._with_data_ids.remove(connection_id)
+            self._with_data_ids.discard(connection_id)
 
     def _on_write(self, *, connection_id, num_bytes_written):
-        if num_bytes_written:
+        if num_bytes_written and connection_id not in self._closed:
             self._with_data_ids.add(connection_id)
 
     def _on_connection_request(self, new_connection):
@@ -54,6 +55,11 @@ class InMemoryConnectionManager:
         new_connection.register_on_read(self._on_read)
         new_connection.register_on_write(self._on_write)
 
+    def close_connection(self, connection_id):
+        self._closed.add(connection_id)
+        self._with_data_ids.discard(connection_id)
+        self._closed_connection_ids.append(connection_id)
+
     def get_activity(self):
         new = self._new_connections[:]
         self._new_connections.clear()
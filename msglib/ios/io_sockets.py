@@ -1,18 +1,62 @@
+from collections.abc import Iterable
 from contextlib import contextmanager
 from dataclasses import dataclass
+import ipaddress
+import os
 import select
 import socket
+import stat
 
 from msglib.broker import ConnectionsActivity
 
 
+class InvalidIPv4(Exception):
+    pass
+
+
 class InvalidIPv6(Exception):
     pass
 
 
+class IPv4(tuple):
+
+    def __new__(cls, *four_octets: int):
+        if len(four_octets) != 4:
+            raise InvalidIPv4(
+                    f'{four_octets}: IPv4 address has 4 octets.')
+        for octet in four_octets:
+            if not 0 <= octet <= 255:
+                raise InvalidIPv4(
+                        f'{octet}: octet should be between'
+                        + ' 0 and 255 (inclusive).'
+                )
+
+        # mypy bug
+        return super().__new__(cls, four_octets)  # type: ignore
+
+    @classmethod
+    def from_string(cls, string):
+        if not isinstance(string, str):
+            raise InvalidIPv4(f'{string!r}: not a string.')
+        try:
+            address = ipaddress.IPv4Address(string)
+        except ValueError as exc:
+            raise InvalidIPv4(str(exc)) from None
+        return cls(*address.packed)
+
+    def __str__(self):
+        return '.'.join(str(octet) for octet in self)
+
+
 class IPv6(tuple):
+    """IPv6 address with the scope id of link-local addresses.
 
-    def __new__(cls, *eight_quartets: int):
+    `scope_id` is an interface index, 0 for unscoped addresses.
+    """
+
+    scope_id: int
+
+    def __new__(cls, *eight_quartets: int, scope_id: int = 0):
         if len(eight_quartets) != 8:
             raise InvalidIPv6(
                     f'{eight_quartets}: IPv6 address has 8 quartets.')
@@ -24,30 +68,127 @@ class IPv6(tuple):
                         + f' 0 and {max_quartet} (inclusive).'
                 )
 
+        if scope_id < 0:
+            raise InvalidIPv6(f'{scope_id}: scope id cannot be negative.')
+
         # mypy bug
-        return super().__new__(cls, eight_quartets)  # type: ignore
+        ip = super().__new__(cls, eight_quartets)  # type: ignore
+        ip.scope_id = scope_id
+        return ip
 
     @classmethod
     def from_string(cls, string):
-        assert string == '::1'
-        return cls(0, 0, 0, 0, 0, 0, 0, 1)
+        """Parse an address, scoped either by interface name or index."""
+        if not isinstance(string, str):
+            raise InvalidIPv6(f'{string!r}: not a string.')
+        try:
+            address = ipaddress.IPv6Address(string)
+        except ValueError as exc:
+            raise InvalidIPv6(str(exc)) from None
+        packed = address.packed
+        return cls(
+                *(
+                    int.from_bytes(packed[i:i + 2], byteorder='big')
+                    for i in range(0, 16, 2)
+                ),
+                scope_id=_scope_id_from_string(address.scope_id),
+        )
+
+    def unscoped(self):
+        return IPv6(*self)
+
+    def __eq__(self, other):
+        if isinstance(other, IPv6):
+            return (
+                    tuple(self) == tuple(other)
+                    and self.scope_id == other.scope_id
+            )
+        return super().__eq__(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((tuple(self), self.scope_id))
 
     def __str__(self):
-        return ':'.join(f'{quartet:04X}' for quartet in self)
+        address = ':'.join(f'{quartet:04X}' for quartet in self)
+        if self.scope_id:
+            return f'{address}%{self.scope_id}'
+        return address
+
+
+def _scope_id_from_string(scope):
+    if scope is None:
+        return 0
+    if scope.isdigit():
+        return int(scope)
+    try:
+        return socket.if_nametoindex(scope)
+    except OSError:
+        raise InvalidIPv6(f'{scope}: unknown network interface.') from None
 
 
 @dataclass(frozen=True, kw_only=True, slots=True)
-class _IPv6ConnectArgs:
-    host: IPv6
+class TCPEndpoint:
+    ip: IPv4 | IPv6
     port: int
 
-    def __iter__(self):
-        return iter((
-            str(self.host),
+    @property
+    def family(self):
+        return socket.AF_INET if isinstance(self.ip, IPv4) else socket.AF_INET6
+
+    def address(self):
+        if isinstance(self.ip, IPv4):
+            return (str(self.ip), self.port)
+        return (
+            str(self.ip.unscoped()),
             self.port,
             0,  # sin6_flowinfo
-            0,  # sin6_scope_id
-        ))
+            self.ip.scope_id,  # sin6_scope_id
+        )
+
+
+@dataclass(frozen=True, kw_only=True, slots=True)
+class UnixEndpoint:
+    path: str
+
+    family = socket.AF_UNIX
+
+    @property
+    def is_abstract(self):
+        return self.path.startswith('\0')
+
+    def address(self):
+        return self.path
+
+
+Endpoint = TCPEndpoint | UnixEndpoint
+
+
+@dataclass(frozen=True, kw_only=True, slots=True)
+class SocketOptions:
+    # Disables Nagle's algorithm. Only applies to TCP sockets.
+    tcp_nodelay: bool = True
+    # Kernel defaults are kept for the buffer sizes left as `None`.
+    send_buffer_bytes: int | None = None
+    receive_buffer_bytes: int | None = None
+
+    def apply(self, socket_):
+        if self.tcp_nodelay and socket_.family != socket.AF_UNIX:
+            socket_.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.send_buffer_bytes is not None:
+            socket_.setsockopt(
+                    socket.SOL_SOCKET,
+                    socket.SO_SNDBUF,
+                    self.send_buffer_bytes,
+            )
+        if self.receive_buffer_bytes is not None:
+            socket_.setsockopt(
+                    socket.SOL_SOCKET,
+                    socket.SO_RCVBUF,
+                    self.receive_buffer_bytes,
+            )
 
 
 class _Connection:
@@ -62,74 +203,200 @@ class _Connection:
     def write(self, bytes_):
         return self._socket.sendall(bytes_)
 
+    def fileno(self):
+        return self._socket.fileno()
+
 
 @contextmanager
-def connect(*, ip: IPv6, port: int, timeout_seconds: float | None):
-    with socket.socket(socket.AF_INET6, socket.SOCK_STREAM) as socket_:
-        socket_.connect(tuple(_IPv6ConnectArgs(host=ip, port=port)))
+def connect(
+        *,
+        timeout_seconds: float | None,
+        ip: IPv4 | IPv6 | None = None,
+        port: int | None = None,
+        endpoint: Endpoint | None = None,
+        socket_options: SocketOptions = SocketOptions(),
+):
+    """Connect either to `endpoint` or to `ip` and `port`."""
+    endpoint = _get_endpoint(ip=ip, port=port, endpoint=endpoint)
+    with socket.socket(endpoint.family, socket.SOCK_STREAM) as socket_:
+        socket_options.apply(socket_)
+        socket_.connect(endpoint.address())
         socket_.settimeout(timeout_seconds)
         yield _Connection(socket_)
 
 
+def _get_endpoint(*, ip, port, endpoint):
+    if endpoint is None:
+        if ip is None or port is None:
+            raise ValueError('Either endpoint or ip and port are required.')
+        return TCPEndpoint(ip=ip, port=port)
+    if ip is not None or port is not None:
+        raise ValueError('Either endpoint or ip and port are accepted.')
+    return endpoint
+
+
 class EpollSocketManager:
+    """Accepts connections on any number of TCP and Unix socket endpoints.
+
+    `ip` and `port` are a shorthand for a single `TCPEndpoint`.
+    A socket file left at a `UnixEndpoint` path by a process that
+    no longer listens on it is replaced. Files of bound `UnixEndpoint`s
+    are removed on exit. Paths starting with a null byte are Linux
+    abstract socket names, which have no files.
+    """
 
-    def __init__(self, ip: IPv6, port: int, epoll_timeout_seconds: float):
-        self._ip = ip
-        self._port = port
-        self._listen_socket: socket.socket
+    def __init__(
+            self,
+            ip: IPv4 | IPv6 | None = None,
+            port: int | None = None,
+            *,
+            epoll_timeout_seconds: float,
+            endpoints: Iterable[Endpoint] = (),
+            backlog: int = socket.SOMAXCONN,
+            socket_options: SocketOptions = SocketOptions(),
+    ):
+        self._endpoints = list(endpoints)
+        if ip is not None or port is not None:
+            self._endpoints.append(
+                    _get_endpoint(ip=ip, port=port, endpoint=None))
+        if not self._endpoints:
+            raise ValueError('At least one endpoint is required.')
+        self._backlog = backlog
+        self._socket_options = socket_options
+        self._listen_sockets: dict[int, socket.socket] = {}
+        self._bound_unix_paths: list[str] = []
+        self._connections: dict[int, socket.socket] = {}
+        self._closed_ids: list[int] = []
         self._epoll: select.epoll
         self._epoll_timeout_s = epoll_timeout_seconds
 
     def __enter__(self):
-        self._listen_socket = socket.socket(
-                socket.AF_INET6, socket.SOCK_STREAM)
-        self._listen_socket.setsockopt(
-                socket.SOL_SOCKET,  # level
-                socket.SO_REUSEADDR,  # optname
-                1,  # value
-        )
-        self._listen_socket.bind(
-                tuple(_IPv6ConnectArgs(host=self._ip, port=self._port)))
-        self._listen_socket.listen(10)
-        self._listen_socket.setblocking(False)
-
         self._epoll = select.epoll()
-        self._epoll.register(self._listen_socket.fileno(), select.EPOLLIN)
-
+        try:
+            for endpoint in self._endpoints:
+                listen_socket = self._listen(endpoint)
+                self._listen_sockets[listen_socket.fileno()] = listen_socket
+                self._epoll.register(listen_socket.fileno(), select.EPOLLIN)
+        except BaseException:
+            self._close()
+            raise
         return self
 
+    def _listen(self, endpoint):
+        listen_socket = socket.socket(endpoint.family, socket.SOCK_STREAM)
+        try:
+            if isinstance(endpoint, UnixEndpoint):
+                if not endpoint.is_abstract:
+                    _remove_stale_socket_file(endpoint.path)
+            else:
+                listen_socket.setsockopt(
+                        socket.SOL_SOCKET,  # level
+                        socket.SO_REUSEADDR,  # optname
+                        1,  # value
+                )
+            # Accepted sockets inherit the buffer sizes.
+            self._socket_options.apply(listen_socket)
+            listen_socket.bind(endpoint.address())
+            if (
+                    isinstance(endpoint, UnixEndpoint)
+                    and not endpoint.is_abstract
+            ):
+                self._bound_unix_paths.append(endpoint.path)
+            listen_socket.listen(self._backlog)
+            listen_socket.setblocking(False)
+        except BaseException:
+            listen_socket.close()
+            raise
+        return listen_socket
+
     def __exit__(self, *args):
-        self._epoll.unregister(self._listen_socket.fileno())
+        self._close()
+
+    def _close(self):
+        for connection in self._connections.values():
+            connection.close()
+        self._connections.clear()
+        for listen_socket in self._listen_sockets.values():
+            listen_socket.close()
+        self._listen_sockets.clear()
         self._epoll.close()
-        self._listen_socket.close()
+        for path in self._bound_unix_paths:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        self._bound_unix_paths.clear()
 
     def get_activity(self):
         epoll_ = self._epoll
-        listen_socket = self._listen_socket
+        listen_sockets = self._listen_sockets
 
         new_connections = []
         readable = []
-        closed = []
+        closed = self._closed_ids[:]
+        self._closed_ids.clear()
         events = epoll_.poll(self._epoll_timeout_s)
         for fileno, event in events:
-            if fileno == listen_socket.fileno():
-                connection, _ = listen_socket.accept()
-                connection.setblocking(False)
-                epoll_.register(connection.fileno(), select.EPOLLIN)
-                new_connections.append(_Connection(connection))
+            if (listen_socket := listen_sockets.get(fileno)) is not None:
+                new_connections.extend(self._accept_all(listen_socket))
             else:
-                processed = False
-                if event & select.EPOLLIN:
+                if event & (select.EPOLLHUP | select.EPOLLRDHUP):
+                    if event & select.EPOLLIN and self._has_data(fileno):
+                        # Epoll is level triggered, so the hang up is
+                        # reported again once all the data is read.
+                        readable.append(fileno)
+                    else:
+                        epoll_.unregister(fileno)
+                        self._connections.pop(fileno).close()
+                        closed.append(fileno)
+                elif event & select.EPOLLIN:
                     readable.append(fileno)
-                    processed = True
-                if event & select.EPOLLHUP:
-                    epoll_.unregister(fileno)
-                    closed.append(fileno)
-                    processed = True
-                if not processed:
+                else:
                     raise ValueError(f'Unexpected event {event}')
         return ConnectionsActivity(
                 new=new_connections,
                 readable_ids=readable,
                 closed_ids=closed,
         )
+
+    def close_connection(self, connection_id):
+        self._epoll.unregister(connection_id)
+        self._connections.pop(connection_id).close()
+        self._closed_ids.append(connection_id)
+
+    def _accept_all(self, listen_socket):
+        # Drain the whole accept queue, so that bursts of connections
+        # do not wait for one poll per connection.
+        while True:
+            try:
+                connection, _ = listen_socket.accept()
+            except BlockingIOError:
+                return
+            self._socket_options.apply(connection)
+            connection.setblocking(False)
+            self._epoll.register(
+                    connection.fileno(),
+                    select.EPOLLIN | select.EPOLLRDHUP,
+            )
+            self._connections[connection.fileno()] = connection
+            yield _Connection(connection)
+
+    def _has_data(self, fileno):
+        try:
+            return bool(self._connections[fileno].recv(1, socket.MSG_PEEK))
+        except ConnectionResetError:
+            return False
+
+
+def _remove_stale_socket_file(path):
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
@@ -0,0 +1,245 @@
+from collections import deque
+from collections.abc import Iterable
+from enum import Enum, auto
+import select
+
+from msglib.broker import Connection
+from msglib.handlers import (
+        ChannelType,
+        ConnectionHandler,
+        MalformedMessage,
+)
+from msglib.message import (
+        deserialize,
+        int_from_bytes,
+        int_to_bytes,
+        serialize,
+)
+
+
+class ReplicationError(Exception):
+    pass
+
+
+class Ack(int, Enum):
+    # Replies to clients are held until every follower
+    # has acknowledged the batch of the same loop iteration.
+    SYNC = auto()
+    # Acknowledgements are read when they are already available,
+    # without holding replies or blocking the loop.
+    ASYNC = auto()
+
+
+class _Kind(int, Enum):
+    BATCH = auto()
+    SNAPSHOT = auto()
+
+
+class _Follower:
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.unacked_seqs: deque[int] = deque()
+        self.acked_seq = 0
+
+
+class ReplicationPrimary:
+    """Streams queue mutations to followers.
+
+    The fields of every mutating queue command are collected during
+    a loop iteration and `flush`, called by the `Broker` at the end
+    of the iteration, sends them to each follower as one batch.
+    A follower that is attached first receives a snapshot of all
+    queues, so it can join a primary that already holds messages.
+
+    A follower that fails to take a batch or acknowledges it wrongly
+    is detached and listed in `failed_followers`, while the primary
+    keeps serving. In sync mode the read timeout of a follower's
+    connection bounds how long it can stall the loop. In async mode
+    a follower is detached once more than `max_unacked_batches`
+    batches sent to it are not acknowledged, e.g. when it stalls
+    or has been promoted. `acked_seq` shows how far followers lag.
+
+    Only `ChannelType.QUEUE` is replicated. Partitioned queues
+    and consumer group offsets are not.
+    """
+
+    def __init__(
+            self,
+            *,
+            handler: ConnectionHandler,
+            followers: Iterable[Connection] = (),
+            ack: Ack = Ack.SYNC,
+            max_unacked_batches: int = 1_000,
+    ):
+        self._queue_handler = handler.get_channel(ChannelType.QUEUE)
+        self._ack = ack
+        self._max_unacked_batches = max_unacked_batches
+        self._raw_channel_type = int_to_bytes(ChannelType.REPLICATION)
+        self._batch: list[bytes] = []
+        self._followers: list[_Follower] = []
+        self.failed_followers: list[tuple[Connection, Exception]] = []
+        self.seq = 0
+        self._queue_handler.add_mutation_listener(self._on_mutation)
+        for connection in followers:
+            self.add_follower(connection)
+
+    @property
+    def acked_seq(self):
+        """Last batch acknowledged by all attached followers."""
+        return min(
+                (follower.acked_seq for follower in self._followers),
+                default=self.seq,
+        )
+
+    def add_follower(self, connection: Connection):
+        """Attach a follower, replacing its state with a snapshot.
+
+        Must be called between loop iterations.
+        """
+        self.flush()
+        fields = [
+            self._raw_channel_type,
+            int_to_bytes(_Kind.SNAPSHOT),
+            int_to_bytes(self.seq),
+        ]
+        for mutation in self._queue_handler.snapshot():
+            fields.append(int_to_bytes(len(mutation)))
+            fields.extend(mutation)
+
+        follower = _Follower(connection)
+        follower.acked_seq = self.seq
+        self._followers.append(follower)
+        self._send(follower, serialize(fields), self.seq)
+        if self._ack is Ack.SYNC:
+            self._await_acks([follower])
+
+    def _on_mutation(self, msg_fields):
+        batch = self._batch
+        batch.append(int_to_bytes(len(msg_fields)))
+        batch.extend(msg_fields)
+
+    def flush(self):
+        if self._batch:
+            self.seq += 1
+            msg = serialize([
+                self._raw_channel_type,
+                int_to_bytes(_Kind.BATCH),
+                int_to_bytes(self.seq),
+            ] + self._batch)
+            self._batch.clear()
+            for follower in list(self._followers):
+                self._send(follower, msg, self.seq)
+
+        if self._ack is Ack.SYNC:
+            self._await_acks(list(self._followers))
+        else:
+            self._read_available_acks()
+
+    def _send(self, follower, msg, seq):
+        try:
+            follower.connection.write(msg)
+        except OSError as exc:
+            self._detach(follower, exc)
+            return
+        follower.unacked_seqs.append(seq)
+        if len(follower.unacked_seqs) > self._max_unacked_batches:
+            self._detach(follower, ReplicationError(
+                    f'Follower has not acknowledged'
+                    + f' {len(follower.unacked_seqs)} batches.'
+            ))
+
+    def _await_acks(self, followers):
+        for follower in followers:
+            try:
+                while follower.unacked_seqs:
+                    self._read_ack(follower)
+            except (OSError, ValueError, ReplicationError) as exc:
+                self._detach(follower, exc)
+
+    def _read_available_acks(self):
+        for follower in list(self._followers):
+            try:
+                while (
+                        follower.unacked_seqs
+                        and _may_have_data(follower.connection)
+                ):
+                    self._read_ack(follower)
+            except BlockingIOError:
+                continue
+            except (OSError, ValueError, ReplicationError) as exc:
+                self._detach(follower, exc)
+
+    @staticmethod
+    def _read_ack(follower):
+        raw_acked_seq, = deserialize(follower.connection)
+        acked_seq = int_from_bytes(raw_acked_seq)
+        expected_seq = follower.unacked_seqs.popleft()
+        if acked_seq != expected_seq:
+            raise ReplicationError(
+                    f'Follower acknowledged batch {acked_seq}'
+                    + f' while {expected_seq} was expected.'
+            )
+        follower.acked_seq = acked_seq
+
+    def _detach(self, follower, exc):
+        self._followers.remove(follower)
+        self.failed_followers.append((follower.connection, exc))
+
+
+def _may_have_data(connection):
+    if (fileno := getattr(connection, 'fileno', None)) is None:
+        # In memory connections raise `BlockingIOError` instead.
+        return True
+    readable, _, _ = select.select([fileno()], [], [], 0)
+    return bool(readable)
+
+
+class ReplicationFollower:
+    """Channel handler that applies batches sent by a `ReplicationPrimary`.
+
+    Every batch is acknowledged with the sequence number of the last
+    applied batch. A batch that does not directly follow it is not
+    applied, so the stale acknowledgement makes the primary detach
+    this follower. A replicated dequeue of a message the follower
+    does not hold is dropped and counted in `divergences`.
+
+    Once promoted, the follower ignores further batches and does not
+    acknowledge them, so the primary detaches it: at once in sync
+    mode, after `max_unacked_batches` batches in async mode.
+    """
+
+    def __init__(self, *, handler: ConnectionHandler):
+        self._queue_handler = handler.get_channel(ChannelType.QUEUE)
+        self._raw_snapshot_kind = int_to_bytes(_Kind.SNAPSHOT)
+        self.applied_seq = 0
+        self.divergences = 0
+        self.promoted = False
+        handler.register_channel(ChannelType.REPLICATION, self)
+
+    def promote(self):
+        self.promoted = True
+
+    def __call__(self, _connection_id, msg_fields):
+        if self.promoted:
+            return None
+
+        if len(msg_fields) < 3:
+            raise MalformedMessage(
+                    f'{len(msg_fields)} fields, at least 3 expected.')
+        _, kind, raw_seq, *mutations = msg_fields
+        seq = int_from_bytes(raw_seq)
+        queue_handler = self._queue_handler
+        if kind == self._raw_snapshot_kind:
+            queue_handler.clear()
+        elif seq != self.applied_seq + 1:
+            return (int_to_bytes(self.applied_seq),)
+
+        i = 0
+        while i < len(mutations):
+            num_fields = int_from_bytes(mutations[i])
+            if not queue_handler.replay(mutations[i + 1:i + 1 + num_fields]):
+                self.divergences += 1
+            i += 1 + num_fields
+        self.applied_seq = seq
+        return (raw_seq,)
@@ -0,0 +1,226 @@
+import threading
+
+import pytest
+
+import msglib.broker
+import msglib.client
+import msglib.embedded
+import msglib.handlers
+import msglib.ios.io_memory
+import msglib.replication
+
+
+def _memory_broker(transport, endpoint_id, handler=None):
+    return msglib.broker.Broker(
+        handler=handler or msglib.handlers.ConnectionHandler(),
+        connection_manager=msglib.ios.io_memory.InMemoryConnectionManager(
+            transport=transport,
+            endpoint_id=endpoint_id,
+        ),
+    )
+
+
+def test_embedded_consumer_is_woken_by_embedded_producer():
+    transport = msglib.ios.io_memory.Transport()
+    payload = {'any': 'object'}
+
+    with (
+        _memory_broker(transport, 'broker') as broker,
+        msglib.embedded.connect(broker) as producer,
+        msglib.embedded.connect(broker) as consumer,
+    ):
+        msglib.client.publish_to_q(connection=producer, q_id=1, payload=None)
+        sub = msglib.client.blocking_pull_subscribe_to_queue(
+                connection=consumer, q_id=1)
+        assert next(sub).payload is None
+
+        class Reader(threading.Thread):
+
+            msg: msglib.client.AckableQMsg
+
+            def run(self):
+                self.msg = next(sub)
+
+        # The broker is never run, the reader blocks until woken.
+        reader = Reader()
+        reader.start()
+        msglib.client.publish_to_q(
+                connection=producer, q_id=1, payload=payload)
+        reader.join(timeout=10)
+
+        assert reader.msg.payload is payload
+
+
+def test_embedded_producer_and_remote_consumer_share_queues():
+    transport = msglib.ios.io_memory.Transport()
+
+    with (
+        _memory_broker(transport, 'broker') as broker,
+        msglib.embedded.connect(broker) as producer,
+        transport.connect('broker') as receiver_connection,
+    ):
+        msglib.client.publish_to_q(
+                connection=producer, q_id=1, payload=b'Hello, world!')
+        sub = msglib.client.blocking_pull_subscribe_to_queue(
+                connection=receiver_connection, q_id=1)
+
+        for _ in range(10):
+            broker.process_connections()
+            try:
+                msg = next(sub)
+            except BlockingIOError:
+                continue
+            break
+        else:
+            raise AssertionError('Did not receive an expected message.')
+
+        assert msg.payload == b'Hello, world!'
+
+
+class _Reader(threading.Thread):
+
+    msg: msglib.client.AckableQMsg
+
+    def __init__(self, sub):
+        super().__init__()
+        self._sub = sub
+
+    def run(self):
+        self.msg = next(self._sub)
+
+
+def test_embedded_pull_waits_for_first_publish():
+    transport = msglib.ios.io_memory.Transport()
+
+    with (
+        _memory_broker(transport, 'broker') as broker,
+        msglib.embedded.connect(broker) as producer,
+        msglib.embedded.connect(broker) as consumer,
+    ):
+        reader = _Reader(msglib.client.blocking_pull_subscribe_to_queue(
+                connection=consumer, q_id=1))
+        reader.start()
+        msglib.client.publish_to_q(connection=producer, q_id=1, payload=b'x')
+        reader.join(timeout=10)
+
+        assert reader.msg.payload == b'x'
+
+
+def test_embedded_group_pull_waits_for_remote_publish():
+    transport = msglib.ios.io_memory.Transport()
+
+    with (
+        _memory_broker(transport, 'broker') as broker,
+        msglib.embedded.connect(broker) as consumer,
+        transport.connect('broker') as producer_connection,
+    ):
+        reader = _Reader(msglib.client.group_pull_subscribe_to_queue(
+                connection=consumer, q_id=1, group_id=2))
+        reader.start()
+        msglib.client.publish_to_partitioned_q(
+                connection=producer_connection,
+                q_id=1,
+                partition_key=b'key',
+                payload=b'Hello, world!',
+        )
+        while reader.is_alive():
+            broker.process_connections()
+
+        assert reader.msg.payload == b'Hello, world!'
+
+
+def test_closed_embedded_connection_leaves_its_groups():
+    transport = msglib.ios.io_memory.Transport()
+
+    with (
+        _memory_broker(transport, 'broker') as broker,
+        msglib.embedded.connect(broker) as producer,
+    ):
+        msglib.client.publish_to_partitioned_q(
+                connection=producer, q_id=1, partition_key=b'k', payload=b'x')
+        with msglib.embedded.connect(broker) as consumer:
+            sub = msglib.client.group_pull_subscribe_to_queue(
+                    connection=consumer, q_id=1, group_id=2)
+            assert next(sub).payload == b'x'
+
+        handler = broker.handler.get_channel(
+                msglib.handlers.ChannelType.PARTITIONED_QUEUE)
+        assert handler.get_assignment(1, 2) == {}
+
+
+def test_replicated_broker_refuses_embedded_connections():
+    transport = msglib.ios.io_memory.Transport()
+    handler = msglib.handlers.ConnectionHandler()
+
+    with msglib.broker.Broker(
+        handler=handler,
+        connection_manager=msglib.ios.io_memory.InMemoryConnectionManager(
+            transport=transport,
+            endpoint_id='broker',
+        ),
+        replicator=msglib.replication.ReplicationPrimary(handler=handler),
+    ) as broker:
+        with pytest.raises(msglib.embedded.ReplicationNotSupported):
+            with msglib.embedded.connect(broker):
+                pass
+
+
+def _receive(broker, sub):
+    for _ in range(10):
+        broker.process_connections()
+        try:
+            return next(sub)
+        except BlockingIOError:
+            continue
+    raise AssertionError('Did not receive an expected message.')
+
+
+def test_remote_pull_waits_for_first_embedded_publish():
+    transport = msglib.ios.io_memory.Transport()
+
+    with (
+        _memory_broker(transport, 'broker') as broker,
+        msglib.embedded.connect(broker) as producer,
+        transport.connect('broker') as receiver_connection,
+    ):
+        sub = msglib.client.blocking_pull_subscribe_to_queue(
+                connection=receiver_connection, q_id=1)
+        with pytest.raises(BlockingIOError):
+            next(sub)
+        broker.process_connections()
+        with pytest.raises(BlockingIOError):
+            next(sub)
+
+        msglib.client.publish_to_q(connection=producer, q_id=1, payload=b'x')
+        assert _receive(broker, sub).payload == b'x'
+
+
+def test_remote_consumer_of_object_payload_is_disconnected():
+    closed = []
+
+    class Handler(msglib.handlers.ConnectionHandler):
+
+        def on_connection_closed(self, connection_id):
+            closed.append(connection_id)
+            super().on_connection_closed(connection_id)
+
+    transport = msglib.ios.io_memory.Transport()
+    with (
+        _memory_broker(transport, 'broker', Handler()) as broker,
+        msglib.embedded.connect(broker) as producer,
+        transport.connect('broker') as first_connection,
+        transport.connect('broker') as second_connection,
+    ):
+        msglib.client.publish_to_q(
+                connection=producer, q_id=1, payload={'any': 'object'})
+        msglib.client.publish_to_q(connection=producer, q_id=1, payload=b'x')
+        first = msglib.client.blocking_pull_subscribe_to_queue(
+                connection=first_connection, q_id=1)
+        with pytest.raises(BlockingIOError):
+            next(first)
+        broker.process_connections()
+        assert len(closed) == 1
+
+        second = msglib.client.blocking_pull_subscribe_to_queue(
+                connection=second_connection, q_id=1)
+        assert _receive(broker, second).payload == b'x'
@@ -0,0 +1,241 @@
+import pytest
+
+import msglib.broker
+import msglib.client
+import msglib.ios.io_memory
+from msglib.handlers import (
+        ChannelType,
+        Command,
+        ConnectionHandler,
+        DispatchMetrics,
+        DispatchStage,
+        MalformedMessage,
+        QMsg,
+        UnknownChannelType,
+        UnknownCommand,
+        UnknownQueue,
+)
+from msglib.message import deserialize, serialize
+
+
+def _msg(command, q_id, payload=None):
+    return list(QMsg(
+            channel_type=ChannelType.QUEUE,
+            command=command,
+            q_id=q_id,
+            payload=payload,
+    ).to_bytes_tuple())
+
+
+def test_publish_then_pull_from_another_connection():
+    handler = ConnectionHandler()
+    handler.on_new_connection('sender')
+    handler.on_new_connection('receiver')
+
+    assert handler.on_message(
+            connection_id='sender',
+            msg_fields=_msg(Command.PUBLISH, 3, b'hi'),
+    ) is None
+    assert handler.on_message(
+            connection_id='receiver',
+            msg_fields=_msg(Command.PULL_MSG, 3),
+    ) == (b'hi',)
+
+
+def test_pull_before_publish_is_answered_by_the_publish():
+    handler = ConnectionHandler()
+    for connection_id in ['closed', 'receiver']:
+        assert handler.on_message(
+                connection_id=connection_id,
+                msg_fields=_msg(Command.PULL_MSG, 7),
+        ) is None
+    handler.on_connection_closed('closed')
+    assert not handler.pop_deferred_replies()
+
+    handler.on_message(
+            connection_id='sender',
+            msg_fields=_msg(Command.PUBLISH, 7, b'hi'),
+    )
+    assert handler.pop_deferred_replies() == [('receiver', (b'hi',))]
+    assert not handler.pop_deferred_replies()
+    with pytest.raises(UnknownQueue):
+        handler.get_channel(ChannelType.QUEUE).get_queue(8)
+
+
+def test_unknown_channel_type_and_command():
+    handler = ConnectionHandler()
+    handler.on_new_connection('conn')
+
+    with pytest.raises(UnknownChannelType):
+        handler.on_message(connection_id='conn', msg_fields=[b'\x7f'])
+    with pytest.raises(UnknownCommand):
+        handler.on_message(
+                connection_id='conn',
+                msg_fields=[bytes([ChannelType.QUEUE]), b'\x7f', b'\x01'],
+        )
+
+
+def test_registered_channel_receives_messages_and_lifecycle_events():
+
+    class Echo:
+
+        def __init__(self):
+            self.open = set()
+
+        def __call__(self, connection_id, msg_fields):
+            return msg_fields[1:]
+
+        def on_new_connection(self, connection_id):
+            self.open.add(connection_id)
+
+        def on_connection_closed(self, connection_id):
+            self.open.remove(connection_id)
+
+    echo_channel_type = 100
+    echo = Echo()
+    handler = ConnectionHandler()
+    handler.register_channel(echo_channel_type, echo)
+
+    handler.on_new_connection('conn')
+    assert echo.open == {'conn'}
+    assert handler.on_message(
+            connection_id='conn',
+            msg_fields=[bytes([echo_channel_type]), b'ping'],
+    ) == [b'ping']
+    handler.on_connection_closed('conn')
+    assert not echo.open
+
+
+def test_dispatch_stages_are_measured():
+    metrics = DispatchMetrics()
+    handler = ConnectionHandler(metrics=metrics)
+    handler.on_new_connection('conn')
+
+    handler.on_message(
+            connection_id='conn',
+            msg_fields=_msg(Command.PUBLISH, 1, b'x'),
+    )
+    handler.on_message(
+            connection_id='conn',
+            msg_fields=_msg(Command.PULL_MSG, 1),
+    )
+
+    for stage in DispatchStage:
+        assert metrics.counts[stage] == 2
+        assert metrics.mean_ns(stage) >= 0
+
+
+def test_broker_closes_connection_sending_invalid_message():
+    closed = []
+
+    class Handler(ConnectionHandler):
+
+        def on_connection_closed(self, connection_id):
+            closed.append(connection_id)
+            super().on_connection_closed(connection_id)
+
+    transport = msglib.ios.io_memory.Transport()
+    with (
+        msglib.broker.Broker(
+            handler=Handler(),
+            connection_manager=msglib.ios.io_memory.InMemoryConnectionManager(
+                transport=transport,
+                endpoint_id='broker',
+            ),
+        ) as broker,
+        transport.connect('broker') as bad_connection,
+        transport.connect('broker') as good_connection,
+    ):
+        bad_connection.write(serialize(_msg(0x7f, 7)))
+        broker.process_connections()
+        broker.process_connections()
+        assert len(closed) == 1
+
+        # Writes to a closed connection are ignored.
+        bad_connection.write(serialize(_msg(0x7f, 7)))
+        msglib.client.publish_to_q(
+                connection=good_connection, q_id=7, payload=b'hi')
+        broker.process_connections()
+        assert len(closed) == 1
+
+
+def test_messages_with_wrong_number_of_fields_are_malformed():
+    handler = ConnectionHandler()
+    handler.on_new_connection('conn')
+    queue = bytes([ChannelType.QUEUE])
+    partitioned_queue = bytes([ChannelType.PARTITIONED_QUEUE])
+
+    for msg_fields in [
+            [],
+            [queue],
+            [queue, bytes([Command.PUBLISH]), b'\x01'],
+            [queue, bytes([Command.PUBLISH]), b'\x01', b'a', b'b'],
+            [queue, bytes([Command.PULL_MSG]), b'\x01', b'a'],
+            [partitioned_queue],
+            [partitioned_queue, bytes([Command.PUBLISH]), b'\x01', b'k'],
+            [partitioned_queue, bytes([Command.PULL_MSG]), b'\x01'],
+            [partitioned_queue, bytes([Command.PULL_MSG]), b'\x01', b'\x02',
+             b'a'],
+    ]:
+        with pytest.raises(MalformedMessage):
+            handler.on_message(connection_id='conn', msg_fields=msg_fields)
+
+
+def test_broker_survives_malformed_messages():
+    transport = msglib.ios.io_memory.Transport()
+    with (
+        msglib.broker.Broker(
+            handler=ConnectionHandler(),
+            connection_manager=msglib.ios.io_memory.InMemoryConnectionManager(
+                transport=transport,
+                endpoint_id='broker',
+            ),
+        ) as broker,
+        transport.connect('broker') as short_connection,
+        transport.connect('broker') as long_connection,
+        transport.connect('broker') as good_connection,
+    ):
+        short_connection.write(serialize([bytes([ChannelType.QUEUE])]))
+        long_connection.write(serialize(
+                _msg(Command.PULL_MSG, 1) + [b'unexpected']))
+        broker.process_connections()
+
+        msglib.client.publish_to_q(
+                connection=good_connection, q_id=1, payload=b'')
+        sub = msglib.client.blocking_pull_subscribe_to_queue(
+                connection=good_connection, q_id=1)
+        broker.process_connections()
+        with pytest.raises(BlockingIOError):
+            next(sub)
+        broker.process_connections()
+        assert next(sub).payload == b''
+
+
+def test_broker_accepts_handler_without_deferred_replies():
+
+    class Echo:
+
+        def on_new_connection(self, connection_id):
+            pass
+
+        def on_connection_closed(self, connection_id):
+            pass
+
+        def on_message(self, *, connection_id, msg_fields):
+            return msg_fields
+
+    transport = msglib.ios.io_memory.Transport()
+    with (
+        msglib.broker.Broker(
+            handler=Echo(),
+            connection_manager=msglib.ios.io_memory.InMemoryConnectionManager(
+                transport=transport,
+                endpoint_id='broker',
+            ),
+        ) as broker,
+        transport.connect('broker') as connection,
+    ):
+        connection.write(serialize([b'ping']))
+        broker.process_connections()
+        broker.process_connections()
+        assert deserialize(connection) == [b'ping']
@@ -0,0 +1,145 @@
+import os
+import socket
+import threading
+
+import pytest
+
+import msglib.broker
+import msglib.client
+import msglib.handlers
+from msglib.ios.io_sockets import (
+        EpollSocketManager,
+        IPv4,
+        IPv6,
+        InvalidIPv4,
+        InvalidIPv6,
+        SocketOptions,
+        TCPEndpoint,
+        UnixEndpoint,
+        connect,
+)
+
+
+def test_ipv4_from_string():
+    assert IPv4.from_string('127.0.0.1') == IPv4(127, 0, 0, 1)
+    assert str(IPv4.from_string('10.20.30.40')) == '10.20.30.40'
+    for invalid in ['127.0.0', '256.0.0.1', '::1', 'localhost', 2130706433]:
+        with pytest.raises(InvalidIPv4):
+            IPv4.from_string(invalid)
+
+
+def test_ipv6_from_string():
+    assert IPv6.from_string('::1') == IPv6(0, 0, 0, 0, 0, 0, 0, 1)
+    assert IPv6.from_string('fe80::1:abcd') == IPv6(
+            0xfe80, 0, 0, 0, 0, 0, 1, 0xabcd)
+    assert IPv6.from_string('::ffff:1.2.3.4') == IPv6(
+            0, 0, 0, 0, 0, 0xffff, 0x0102, 0x0304)
+    for invalid in ['1::2::3', '12345::', '127.0.0.1', 1, b'::1']:
+        with pytest.raises(InvalidIPv6):
+            IPv6.from_string(invalid)
+
+
+def test_ipv6_scope_id_is_kept():
+    lo_index = socket.if_nametoindex('lo')
+    ip = IPv6.from_string('fe80::1%lo')
+
+    assert ip.scope_id == lo_index
+    assert ip == IPv6.from_string(f'fe80::1%{lo_index}')
+    assert ip != IPv6.from_string('fe80::1')
+    assert str(ip).endswith(f'%{lo_index}')
+    assert TCPEndpoint(ip=ip, port=1).address() == (
+            'FE80:0000:0000:0000:0000:0000:0000:0001', 1, 0, lo_index)
+    with pytest.raises(InvalidIPv6):
+        IPv6.from_string('fe80::1%no-such-interface')
+
+
+def test_unix_socket_file_removed_before_exit(tmp_path):
+    endpoint = UnixEndpoint(path=os.fspath(tmp_path / 'broker.sock'))
+
+    with EpollSocketManager(endpoints=[endpoint], epoll_timeout_seconds=0):
+        os.unlink(endpoint.path)
+
+
+def test_abstract_unix_socket():
+    endpoint = UnixEndpoint(path=f'\0msglib-test-{os.getpid()}')
+
+    with (
+            msglib.broker.Broker(
+                handler=msglib.handlers.ConnectionHandler(),
+                connection_manager=EpollSocketManager(
+                    endpoints=[endpoint],
+                    epoll_timeout_seconds=0.001,
+                ),
+            ) as broker,
+            connect(endpoint=endpoint, timeout_seconds=10) as connection,
+    ):
+        msglib.client.publish_to_q(
+                connection=connection, q_id=1, payload=b'x')
+        sub = msglib.client.blocking_pull_subscribe_to_queue(
+                connection=connection, q_id=1)
+
+        class Reader(threading.Thread):
+
+            msg: msglib.client.AckableQMsg
+
+            def run(self):
+                self.msg = next(sub)
+
+        reader = Reader()
+        reader.start()
+        while reader.is_alive():
+            broker.process_connections()
+
+        assert reader.msg.payload == b'x'
+
+
+def test_one_broker_listening_on_unix_and_ipv4_sockets(tmp_path):
+    unix_endpoint = UnixEndpoint(path=os.fspath(tmp_path / 'broker.sock'))
+    tcp_endpoint = TCPEndpoint(ip=IPv4.from_string('127.0.0.1'), port=12348)
+
+    with (
+            msglib.broker.Broker(
+                handler=msglib.handlers.ConnectionHandler(),
+                connection_manager=EpollSocketManager(
+                    endpoints=[unix_endpoint, tcp_endpoint],
+                    epoll_timeout_seconds=0.001,
+                    backlog=128,
+                    socket_options=SocketOptions(
+                        send_buffer_bytes=2 ** 16,
+                        receive_buffer_bytes=2 ** 16,
+                    ),
+                ),
+            ) as broker,
+            connect(
+                endpoint=unix_endpoint, timeout_seconds=10,
+            ) as sender_connection,
+            connect(
+                endpoint=tcp_endpoint, timeout_seconds=10,
+            ) as receiver_connection,
+    ):
+        msglib.client.publish_to_q(
+            connection=sender_connection,
+            q_id=1,
+            payload=b'Hello, world!',
+        )
+        sub = msglib.client.blocking_pull_subscribe_to_queue(
+            connection=receiver_connection,
+            q_id=1,
+        )
+
+        class Reader(threading.Thread):
+
+            msg: msglib.client.AckableQMsg
+
+            def run(self):
+                self.msg = next(sub)
+
+        reader = Reader()
+        reader.start()
+
+        while reader.is_alive():
+            broker.process_connections()
+
+        assert reader.msg.payload == b'Hello, world!'
+
+    assert not os.path.exists(unix_endpoint.path)
@@ -0,0 +1,238 @@
+import os
+import zlib
+
+import pytest
+
+import msglib.broker
+import msglib.client
+import msglib.handlers
+import msglib.ios.io_memory
+import msglib.ios.io_sockets
+from msglib.handlers import (
+        ChannelType,
+        ConnectionHandler,
+        GroupPullMsg,
+        PartitionedPublishMsg,
+)
+from msglib.message import serialize
+
+
+def _publish(handler, *, q_id, key, payload):
+    handler.on_message(
+            connection_id='publisher',
+            msg_fields=list(PartitionedPublishMsg(
+                q_id=q_id, partition_key=key, payload=payload,
+            ).to_bytes_tuple()),
+    )
+
+
+def _pull(handler, *, connection_id, q_id, group_id):
+    return handler.on_message(
+            connection_id=connection_id,
+            msg_fields=list(GroupPullMsg(
+                q_id=q_id, group_id=group_id,
+            ).to_bytes_tuple()),
+    )
+
+
+def _drain(handler, *, connection_id, q_id, group_id):
+    payloads = []
+    while (reply := _pull(
+            handler,
+            connection_id=connection_id,
+            q_id=q_id,
+            group_id=group_id,
+    )):
+        payloads.append(reply[0])
+    return payloads
+
+
+def test_group_members_split_partitions_keeping_per_key_order():
+    handler = ConnectionHandler(num_partitions=4)
+    keys = [b'a', b'b', b'c', b'd', b'e']
+    for i in range(3):
+        for key in keys:
+            _publish(handler, q_id=1, key=key, payload=key + bytes([i]))
+    # Both members join before either drains.
+    assert _pull(handler, connection_id='m1', q_id=1, group_id=1)
+    assert _pull(handler, connection_id='m2', q_id=1, group_id=1)
+
+    assignment = handler.get_channel(
+            ChannelType.PARTITIONED_QUEUE).get_assignment(1, 1)
+    assert sorted(assignment['m1'] + assignment['m2']) == [0, 1, 2, 3]
+    assert not set(assignment['m1']) & set(assignment['m2'])
+
+    received = (
+            _drain(handler, connection_id='m1', q_id=1, group_id=1)
+            + _drain(handler, connection_id='m2', q_id=1, group_id=1)
+    )
+    assert len(received) == 3 * len(keys) - 2
+    for key in keys:
+        indices = [msg[1] for msg in received if msg[:1] == key]
+        assert indices == sorted(indices)
+
+
+def test_closed_member_partitions_are_reassigned():
+    handler = ConnectionHandler(num_partitions=4)
+    _publish(handler, q_id=1, key=b'k', payload=b'first')
+    _pull(handler, connection_id='m1', q_id=1, group_id=1)
+    _pull(handler, connection_id='m2', q_id=1, group_id=1)
+
+    handler.on_connection_closed('m1')
+    handler.on_connection_closed('m2')
+    for i in range(5):
+        _publish(handler, q_id=1, key=bytes([i]), payload=bytes([i]))
+
+    assert sorted(_drain(
+            handler, connection_id='m3', q_id=1, group_id=1,
+    )) == [bytes([i]) for i in range(5)]
+
+
+def test_every_group_receives_messages_published_after_it_joined():
+    handler = ConnectionHandler(num_partitions=2)
+    _publish(handler, q_id=1, key=b'k', payload=b'first')
+    assert _pull(
+            handler, connection_id='m1', q_id=1, group_id=1) == (b'first',)
+    # Already consumed by every group that existed at the time.
+    assert _pull(handler, connection_id='m2', q_id=1, group_id=2) is None
+
+    for i in range(4):
+        _publish(handler, q_id=1, key=bytes([i]), payload=bytes([i]))
+    # The waiting pull of group 2 was answered by the first publish.
+    (member, (first,)), = handler.pop_deferred_replies()
+    assert member == 'm2'
+    assert sorted(_drain(
+            handler, connection_id='m1', q_id=1, group_id=1,
+    )) == [bytes([i]) for i in range(4)]
+    assert sorted([first] + _drain(
+            handler, connection_id='m2', q_id=1, group_id=2,
+    )) == [bytes([i]) for i in range(4)]
+
+
+def test_pull_before_publish_is_answered_by_the_publish():
+    handler = ConnectionHandler(num_partitions=4)
+    assert _pull(handler, connection_id='m', q_id=5, group_id=1) is None
+    assert not handler.pop_deferred_replies()
+
+    _publish(handler, q_id=5, key=b'k', payload=b'hi')
+    assert handler.pop_deferred_replies() == [('m', (b'hi',))]
+    assert not handler.pop_deferred_replies()
+
+
+def test_waiting_member_is_answered_after_rebalance():
+    handler = ConnectionHandler(num_partitions=2)
+    _publish(handler, q_id=1, key=b'k', payload=b'first')
+    _pull(handler, connection_id='m1', q_id=1, group_id=1)
+    assert _pull(handler, connection_id='m2', q_id=1, group_id=1) is None
+    assignment = handler.get_channel(
+            ChannelType.PARTITIONED_QUEUE).get_assignment(1, 1)
+    m1_key = next(
+            bytes([i]) for i in range(256)
+            if zlib.crc32(bytes([i])) % 2 in assignment['m1']
+    )
+    _publish(handler, q_id=1, key=m1_key, payload=b'second')
+    assert not handler.pop_deferred_replies()
+
+    handler.on_connection_closed('m1')
+    assert handler.pop_deferred_replies() == [('m2', (b'second',))]
+
+
+def test_retention_is_bounded_for_groups_without_members():
+    handler = ConnectionHandler(num_partitions=1, max_partition_length=10)
+    _publish(handler, q_id=1, key=b'k', payload=b'first')
+    _pull(handler, connection_id='m1', q_id=1, group_id=1)
+    handler.on_connection_closed('m1')
+
+    for i in range(1000):
+        _publish(handler, q_id=1, key=b'k', payload=i.to_bytes(2, 'big'))
+
+    assert _drain(handler, connection_id='m2', q_id=1, group_id=1) == [
+            i.to_bytes(2, 'big') for i in range(990, 1000)]
+
+
+def test_group_pull_in_memory():
+    memory_transport = msglib.ios.io_memory.Transport()
+    broker_endpoint = 'broker'
+
+    with (
+        msglib.broker.Broker(
+            handler=msglib.handlers.ConnectionHandler(),
+            connection_manager=msglib.ios.io_memory.InMemoryConnectionManager(
+                transport=memory_transport,
+                endpoint_id=broker_endpoint,
+            ),
+        ) as broker,
+        memory_transport.connect(broker_endpoint) as sender_connection,
+        memory_transport.connect(broker_endpoint) as receiver_connection,
+    ):
+        # The consumer starts first, its pull waits in the broker.
+        sub = msglib.client.group_pull_subscribe_to_queue(
+            connection=receiver_connection,
+            q_id=1,
+            group_id=1,
+        )
+        with pytest.raises(BlockingIOError):
+            next(sub)
+        broker.process_connections()
+        with pytest.raises(BlockingIOError):
+            next(sub)
+
+        msglib.client.publish_to_partitioned_q(
+            connection=sender_connection,
+            q_id=1,
+            partition_key=b'user-1',
+            payload=b'Hello, world!',
+        )
+
+        for _ in range(10):
+            broker.process_connections()
+            try:
+                msg = next(sub)
+            except BlockingIOError:
+                continue
+            break
+        else:
+            raise AssertionError('Did not receive an expected message.')
+
+        assert msg.payload == b'Hello, world!'
+
+
+def test_no_reply_to_waiting_member_closed_for_invalid_message(tmp_path):
+
+    class Handler(ConnectionHandler):
+
+        def on_message(self, *, connection_id, msg_fields):
+            try:
+                return super().on_message(
+                        connection_id=connection_id, msg_fields=msg_fields)
+            except msglib.broker.InvalidMessage:
+                # An embedded publish from another thread can land
+                # before the broker writes the deferred replies.
+                self.get_channel(ChannelType.PARTITIONED_QUEUE).publish(
+                        1, b'k', b'x')
+                raise
+
+    handler = Handler(num_partitions=1)
+    endpoint = msglib.ios.io_sockets.UnixEndpoint(
+            path=os.fspath(tmp_path / 'broker.sock'))
+    with (
+        msglib.broker.Broker(
+            handler=handler,
+            connection_manager=msglib.ios.io_sockets.EpollSocketManager(
+                endpoints=[endpoint],
+                epoll_timeout_seconds=0.001,
+            ),
+        ) as broker,
+        msglib.ios.io_sockets.connect(
+            endpoint=endpoint, timeout_seconds=10,
+        ) as connection,
+    ):
+        # A waiting group pull followed by an unknown channel type.
+        connection.write(
+                serialize(GroupPullMsg(q_id=1, group_id=1).to_bytes_tuple())
+                + b'\x01\x7f'
+        )
+        # The reply is not written to the closed connection.
+        for _ in range(10):
+            broker.process_connections()
+        assert connection.read(1) == b''
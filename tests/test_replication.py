@@ -0,0 +1,309 @@
+import threading
+
+import msglib.broker
+import msglib.client
+import msglib.handlers
+import msglib.ios.io_sockets
+import msglib.replication
+from msglib.message import deserialize, serialize
+
+
+class _BrokerThread(threading.Thread):
+
+    def __init__(self, broker):
+        super().__init__()
+        self._broker = broker
+        self.stop = threading.Event()
+
+    def run(self):
+        while not self.stop.is_set():
+            self._broker.process_connections()
+
+
+def _connect(*, ip, port):
+    return msglib.ios.io_sockets.connect(
+            ip=ip, port=port, timeout_seconds=10)
+
+
+def _pull(*, broker, sub):
+
+    class Reader(threading.Thread):
+
+        msg: msglib.client.AckableQMsg
+
+        def run(self):
+            self.msg = next(sub)
+
+    reader = Reader()
+    reader.start()
+    while reader.is_alive():
+        broker.process_connections()
+    return reader.msg
+
+
+def test_promoted_follower_serves_replicated_messages():
+    ip = msglib.ios.io_sockets.IPv6.from_string('::1')
+    primary_port = 12346
+    follower_port = 12347
+    q_id = 1
+
+    follower_handler = msglib.handlers.ConnectionHandler()
+    follower = msglib.replication.ReplicationFollower(
+            handler=follower_handler)
+    primary_handler = msglib.handlers.ConnectionHandler()
+
+    with msglib.broker.Broker(
+            handler=follower_handler,
+            connection_manager=msglib.ios.io_sockets.EpollSocketManager(
+                    ip=ip, port=follower_port, epoll_timeout_seconds=0.001),
+    ) as follower_broker:
+        follower_thread = _BrokerThread(follower_broker)
+        follower_thread.start()
+        try:
+            with _connect(ip=ip, port=follower_port) as to_follower:
+                replicator = msglib.replication.ReplicationPrimary(
+                        handler=primary_handler,
+                        followers=[to_follower],
+                        ack=msglib.replication.Ack.SYNC,
+                )
+                with (
+                        msglib.broker.Broker(
+                            handler=primary_handler,
+                            connection_manager=(
+                                msglib.ios.io_sockets.EpollSocketManager(
+                                    ip=ip,
+                                    port=primary_port,
+                                    epoll_timeout_seconds=0.001,
+                                )
+                            ),
+                            replicator=replicator,
+                        ) as primary_broker,
+                        _connect(ip=ip, port=primary_port) as client,
+                ):
+                    for payload in [b'first', b'second']:
+                        msglib.client.publish_to_q(
+                                connection=client,
+                                q_id=q_id,
+                                payload=payload,
+                        )
+                    # Pulling on the same connection makes sure
+                    # both publishes are processed first.
+                    msg = _pull(
+                        broker=primary_broker,
+                        sub=msglib.client.blocking_pull_subscribe_to_queue(
+                            connection=client, q_id=q_id),
+                    )
+                    assert msg.payload == b'first'
+                    assert replicator.acked_seq == replicator.seq > 0
+        finally:
+            follower_thread.stop.set()
+            follower_thread.join()
+
+        assert follower.applied_seq == replicator.seq
+        follower.promote()
+
+        with _connect(ip=ip, port=follower_port) as receiver:
+            msg = _pull(
+                broker=follower_broker,
+                sub=msglib.client.blocking_pull_subscribe_to_queue(
+                    connection=receiver, q_id=q_id),
+            )
+        assert msg.payload == b'second'
+
+
+class _ByteReader:
+
+    def __init__(self, bytes_):
+        self._bytes = iter(bytes_)
+
+    def read(self, num_bytes):
+        return [next(self._bytes) for _ in range(num_bytes)]
+
+
+class _DirectConnection:
+    """Delivers writes to a follower handler as soon as they are made."""
+
+    def __init__(self, handler):
+        self._handler = handler
+        self._replies = bytearray()
+
+    def write(self, bytes_):
+        reply = self._handler.on_message(
+                connection_id='primary',
+                msg_fields=deserialize(_ByteReader(bytes_)),
+        )
+        if reply is not None:
+            self._replies.extend(serialize(reply))
+
+    def read(self, num_bytes):
+        if len(self._replies) < num_bytes:
+            raise BlockingIOError()
+        read = self._replies[:num_bytes]
+        del self._replies[:num_bytes]
+        return read
+
+
+class _BrokenConnection:
+
+    def write(self, bytes_):
+        raise BrokenPipeError()
+
+    def read(self, num_bytes):
+        raise BrokenPipeError()
+
+
+def _q_msg(command, payload=None):
+    return list(msglib.handlers.QMsg(
+            channel_type=msglib.handlers.ChannelType.QUEUE,
+            command=command,
+            q_id=1,
+            payload=payload,
+    ).to_bytes_tuple())
+
+
+def _publish(handler, payload):
+    handler.on_message(
+            connection_id='client',
+            msg_fields=_q_msg(msglib.handlers.Command.PUBLISH, payload),
+    )
+
+
+def _pull_now(handler):
+    return handler.on_message(
+            connection_id='client',
+            msg_fields=_q_msg(msglib.handlers.Command.PULL_MSG),
+    )
+
+
+def test_follower_attached_late_receives_snapshot():
+    primary_handler = msglib.handlers.ConnectionHandler()
+    for payload in [b'first', b'second', b'third']:
+        _publish(primary_handler, payload)
+    assert _pull_now(primary_handler) == (b'first',)
+
+    follower_handler = msglib.handlers.ConnectionHandler()
+    follower = msglib.replication.ReplicationFollower(
+            handler=follower_handler)
+    replicator = msglib.replication.ReplicationPrimary(
+            handler=primary_handler,
+            followers=[_DirectConnection(follower_handler)],
+    )
+
+    assert _pull_now(primary_handler) == (b'second',)
+    replicator.flush()
+
+    assert replicator.acked_seq == replicator.seq == 1
+    assert not replicator.failed_followers
+    assert follower.divergences == 0
+    assert _pull_now(follower_handler) == (b'third',)
+
+
+def test_replicated_dequeue_of_missing_message_is_dropped():
+    primary_handler = msglib.handlers.ConnectionHandler()
+    follower_handler = msglib.handlers.ConnectionHandler()
+    follower = msglib.replication.ReplicationFollower(
+            handler=follower_handler)
+    replicator = msglib.replication.ReplicationPrimary(
+            handler=primary_handler,
+            followers=[_DirectConnection(follower_handler)],
+    )
+    _publish(primary_handler, b'msg')
+    replicator.flush()
+    follower_handler.get_channel(
+            msglib.handlers.ChannelType.QUEUE).clear()
+
+    _pull_now(primary_handler)
+    replicator.flush()
+
+    assert follower.divergences == 1
+    assert follower.applied_seq == replicator.acked_seq == 2
+
+
+def test_failed_followers_are_detached():
+    primary_handler = msglib.handlers.ConnectionHandler()
+    follower_handler = msglib.handlers.ConnectionHandler()
+    follower = msglib.replication.ReplicationFollower(
+            handler=follower_handler)
+    broken = _BrokenConnection()
+    healthy = _DirectConnection(follower_handler)
+    replicator = msglib.replication.ReplicationPrimary(
+            handler=primary_handler, followers=[broken, healthy])
+    assert [conn for conn, _ in replicator.failed_followers] == [broken]
+
+    _publish(primary_handler, b'msg')
+    replicator.flush()
+    assert replicator.acked_seq == 1
+
+    # A promoted follower no longer acknowledges.
+    follower.promote()
+    _publish(primary_handler, b'msg')
+    replicator.flush()
+    assert [conn for conn, _ in replicator.failed_followers] == [
+            broken, healthy]
+    assert _pull_now(primary_handler) == (b'msg',)
+
+
+def test_async_acknowledgements_are_tracked():
+    primary_handler = msglib.handlers.ConnectionHandler()
+    follower_handler = msglib.handlers.ConnectionHandler()
+    msglib.replication.ReplicationFollower(handler=follower_handler)
+    replicator = msglib.replication.ReplicationPrimary(
+            handler=primary_handler,
+            followers=[_DirectConnection(follower_handler)],
+            ack=msglib.replication.Ack.ASYNC,
+    )
+
+    for payload in [b'a', b'b']:
+        _publish(primary_handler, payload)
+        replicator.flush()
+
+    assert replicator.acked_seq == replicator.seq == 2
+    assert not replicator.failed_followers
+
+
+def test_async_follower_that_stops_acknowledging_is_detached():
+    primary_handler = msglib.handlers.ConnectionHandler()
+    follower_handler = msglib.handlers.ConnectionHandler()
+    follower = msglib.replication.ReplicationFollower(
+            handler=follower_handler)
+    connection = _DirectConnection(follower_handler)
+    replicator = msglib.replication.ReplicationPrimary(
+            handler=primary_handler,
+            followers=[connection],
+            ack=msglib.replication.Ack.ASYNC,
+            max_unacked_batches=2,
+    )
+    follower.promote()
+
+    for _ in range(2):
+        _publish(primary_handler, b'msg')
+        replicator.flush()
+    assert not replicator.failed_followers
+    assert replicator.acked_seq == 0
+
+    _publish(primary_handler, b'msg')
+    replicator.flush()
+    assert [conn for conn, _ in replicator.failed_followers] == [connection]
+    assert replicator.acked_seq == replicator.seq
+
+
+def test_waiting_pull_answered_by_publish_is_replicated():
+    primary_handler = msglib.handlers.ConnectionHandler()
+    follower_handler = msglib.handlers.ConnectionHandler()
+    follower = msglib.replication.ReplicationFollower(
+            handler=follower_handler)
+    replicator = msglib.replication.ReplicationPrimary(
+            handler=primary_handler,
+            followers=[_DirectConnection(follower_handler)],
+    )
+    assert _pull_now(primary_handler) is None
+    replicator.flush()
+    assert replicator.seq == 0
+
+    _publish(primary_handler, b'first')
+    _publish(primary_handler, b'second')
+    replicator.flush()
+
+    assert primary_handler.pop_deferred_replies() == [('client', (b'first',))]
+    assert follower.divergences == 0
+    assert _pull_now(follower_handler) == (b'second',)